@@ -5,7 +5,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torchvision import datasets, transforms
+from torchvision import datasets
 
 import pytorch_pfn_extras as ppe
 import pytorch_pfn_extras.training.extensions as extensions
@@ -36,34 +36,75 @@ class Net(nn.Module):
         return F.log_softmax(x, dim=1)
 
 
-def train(manager, args, model, device, train_loader):
+def train(manager, args, model, device, train_data, train_target,
+          comm_world_size, comm_rank):
+    # Every rank draws the same permutation and takes a disjoint, equally
+    # sized shard of it, which replaces DistributedSampler. The last partial
+    # batch is dropped so that every iteration has the same input shape.
+    generator = torch.Generator(device=device)
+    generator.manual_seed(args.seed)
+    num_samples = len(train_data) // comm_world_size
+    num_samples -= num_samples % args.batch_size
     while not manager.stop_trigger:
         model.train()
-        for _, (data, target) in enumerate(train_loader):
+        perm = torch.randperm(
+            len(train_data), generator=generator, device=device)
+        local_perm = perm[
+            comm_rank:num_samples * comm_world_size:comm_world_size]
+        for batch_indices in local_perm.split(args.batch_size):
             with manager.run_iteration(step_optimizers=['main']):
-                data, target = data.to(device), target.to(device)
+                data = train_data[batch_indices]
+                target = train_target[batch_indices]
                 output = model(data)
                 loss = F.nll_loss(output, target)
-                ppe.reporting.report({'train/loss': loss.item()})
+                # Reporting the tensor avoids a device sync every iteration,
+                # LogReport accumulates it and copies the mean to the host
+                # only when it writes the log
+                ppe.reporting.report({'train/loss': loss.detach()})
                 loss.backward()
 
 
-def test(args, model, device, data, target):
+def load_mnist(dataset, device):
+    """ MNIST is small enough to be kept in device memory, so it is
+        normalized once and batches are indexed directly instead of
+        going through a DataLoader
+    """
+    data = dataset.data.unsqueeze(1).float().div_(255)
+    data = data.sub_(0.1307).div_(0.3081)
+    return (data.to(device, non_blocking=True),
+            dataset.targets.to(device, non_blocking=True))
+
+
+def test(args, model, data, target):
     """ The extension loops over the iterator in order to
         drive the evaluator progress bar and reporting
         averages
     """
     model.eval()
-    test_loss = 0
-    correct = 0
-    data, target = data.to(device), target.to(device)
     output = model(data)
-    # Final result will be average of averages of the same size
-    test_loss += F.nll_loss(output, target, reduction='mean').item()
+    # Final result will be average of averages of the same size.
+    # Values are reported as tensors so they are accumulated on the
+    # device and only copied to the host when the log is written
+    test_loss = F.nll_loss(output, target, reduction='mean')
     ppe.reporting.report({'val/loss': test_loss})
     pred = output.argmax(dim=1, keepdim=True)
-    correct += pred.eq(target.view_as(pred)).sum().item()
-    ppe.reporting.report({'val/acc': correct / len(data)})
+    accuracy = pred.eq(target.view_as(pred)).float().mean()
+    ppe.reporting.report({'val/acc': accuracy})
+
+
+def bf16_compress_reduce(values, group):
+    """ All-reduces the gradients in bfloat16, halving the bytes sent
+        at the cost of precision in the averaged gradients
+    """
+    coalesced = torch._utils._flatten_dense_tensors(values)
+    coalesced = coalesced.to(torch.bfloat16)
+    torch.distributed.all_reduce(coalesced, group=group)
+    coalesced = coalesced.to(values[0].dtype)
+    coalesced.div_(torch.distributed.get_world_size(group))
+    with torch.no_grad():
+        reduced = torch._utils._unflatten_dense_tensors(coalesced, values)
+        for value, reduced_value in zip(values, reduced):
+            value.copy_(reduced_value)
 
 
 def init_distributed(use_cuda=True):
@@ -79,6 +120,11 @@ def init_distributed(use_cuda=True):
         print("World size = {}".format(comm_world_size))
     print("Rank = {}, Local Rank = {}".format(comm_rank, comm_local_rank))
 
+    # The gradients of this model are small (~1.7MB), so cap the resources
+    # NCCL uses for them. Values set by the user take precedence.
+    os.environ.setdefault("NCCL_NTHREADS", "64")
+    os.environ.setdefault("NCCL_MAX_NCHANNELS", "2")
+
     torch.cuda.set_device(comm_local_rank)
     torch.distributed.init_process_group(backend='nccl', init_method='env://')
 
@@ -114,6 +160,11 @@ def main():
     parser.add_argument('--no-lazy', dest='lazy',
                         action='store_false', default=True,
                         help='do not use lazy modules')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='compile the model with torch.compile')
+    parser.add_argument('--bf16-allreduce', action='store_true',
+                        default=False,
+                        help='all-reduce gradients in bfloat16')
     args = parser.parse_args()
     use_cuda = args.cuda and torch.cuda.is_available()
 
@@ -128,56 +179,53 @@ def main():
     print("Rank = {}, Local Rank = {}".format(comm_rank, comm_local_rank))
     print("Device = {}".format(device))
 
-    kwargs = {'num_workers': 1, 'pin_memory': True} if use_cuda else {}
     dataset_root = '../data'
     if comm_local_rank == 0:
         # download mnist
         datasets.MNIST(dataset_root, download=True)
     torch.distributed.barrier()
 
-    train_dataset = datasets.MNIST(
-        dataset_root,
-        train=True,
-        transform=transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize((0.1307,), (0.3081,)),
-        ]))
-    test_dataset = datasets.MNIST(
-        dataset_root,
-        train=False,
-        transform=transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize((0.1307,), (0.3081,)),
-        ]))
-
-    train_sampler = torch.utils.data.DistributedSampler(
-        train_dataset, num_replicas=comm_world_size, rank=comm_rank)
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, sampler=train_sampler,
-        **kwargs)
-
-    test_dataset_indices = list(range(len(test_dataset)))
-    local_test_dataset_indices = test_dataset_indices[
-        comm_rank:len(test_dataset_indices):comm_world_size]
-    local_test_dataset = torch.utils.data.Subset(
-        test_dataset, local_test_dataset_indices)
-    test_loader = torch.utils.data.DataLoader(
-        local_test_dataset, batch_size=args.test_batch_size, shuffle=True,
-        **kwargs)
+    train_dataset = datasets.MNIST(dataset_root, train=True)
+    train_data, train_target = load_mnist(train_dataset, device)
+    iters_per_epoch = len(train_data) // comm_world_size // args.batch_size
+    test_dataset = datasets.MNIST(dataset_root, train=False)
+    test_data, test_target = load_mnist(test_dataset, device)
+
+    # A strided slice takes this rank's shard as a view, without building
+    # an index list or gathering a copy
+    local_test_dataset_indices = slice(comm_rank, None, comm_world_size)
+    local_test_data = test_data[local_test_dataset_indices]
+    local_test_target = test_target[local_test_dataset_indices]
+    test_batches = list(zip(
+        local_test_data.split(args.test_batch_size),
+        local_test_target.split(args.test_batch_size)))
 
     model = Net(args.lazy)
     model.to(device)
     if args.lazy:
         # You need to run a dummy forward to initialize parameters.
         # This should be done before passing parameter list to optimizers.
-        dummy_input = train_loader.dataset[0][0].unsqueeze(0).to(device)
+        dummy_input = train_data[:1]
         model(dummy_input)
 
-    model = ppe.nn.parallel.DistributedDataParallel(model)
-
+    # The optimizer is built on the bare module, whose parameters are shared
+    # with the wrapper. ppe's DistributedDataParallel all-reduces every
+    # gradient in a single coalesced call once backward has finished, and
+    # the manager steps the optimizer right after it.
     optimizer = optim.SGD(
         model.parameters(), lr=args.lr, momentum=args.momentum)
 
+    if args.compile:
+        # Fuses the layers of this small model into fewer kernels and
+        # replays them with CUDA graphs to cut the launch overhead.
+        # DistributedDataParallel has to wrap the compiled module.
+        model = torch.compile(
+            model, backend='inductor', mode='reduce-overhead')
+
+    model = ppe.nn.parallel.DistributedDataParallel(
+        model,
+        reduce_function=bf16_compress_reduce if args.bf16_allreduce else None)
+
     # manager.extend(...) also works
     if comm_local_rank == 0:
         my_extensions = [
@@ -187,9 +235,9 @@ def main():
             extensions.ParameterStatistics(model, prefix='model'),
             extensions.VariableStatisticsPlot(model),
             extensions.Evaluator(
-                test_loader, model,
+                {'main': test_batches}, model,
                 eval_func=lambda data, target:
-                    test(args, model, device, data, target),
+                    test(args, model, data, target),
                 progress_bar=True),
             extensions.PlotReport(
                 ['train/loss', 'val/loss'], 'epoch', filename='loss.png'),
@@ -210,16 +258,17 @@ def main():
     manager = ppe.training.ExtensionsManager(
         model, optimizer, args.epochs,
         extensions=my_extensions,
-        iters_per_epoch=len(train_loader),
+        iters_per_epoch=iters_per_epoch,
         stop_trigger=trigger)
     # Lets load the snapshot
     if args.snapshot is not None:
         state = torch.load(args.snapshot)
         manager.load_state_dict(state)
-    train(manager, args, model, device, train_loader)
+    train(manager, args, model, device, train_data, train_target,
+          comm_world_size, comm_rank)
     # Test function is called from the evaluator extension
     # to get access to the reporter and other facilities
-    # test(args, model, device, test_loader)
+    # test(args, model, data, target)
 
     if (args.save_model):
         torch.save(model.state_dict(), "mnist_cnn.pt")
@@ -1,3 +1,6 @@
+import itertools
+import operator
+
 from pytorch_pfn_extras.dataset.tabular import tabular_dataset
 from pytorch_pfn_extras.dataset.tabular import _utils
 
@@ -20,6 +23,8 @@ class _TransformBase(tabular_dataset.TabularDataset):
                 'Transformations must produce only all specified keys')
 
         self._keys = keys
+        self._candidate_transforms = {}
+        self._plans = {}
 
     def __len__(self):
         return len(self._dataset)
@@ -35,11 +40,17 @@ class _TransformBase(tabular_dataset.TabularDataset):
         return self._mode
 
     def _find_candidate_transforms(self, key_indices):
-        # TODO: memoize
+        # The candidates only depend on which keys are requested,
+        # get_examples is called once per batch so the result is memoized
+        key_index_set = frozenset(key_indices)  # sometimes we get ranges
+        if key_index_set not in self._candidate_transforms:
+            self._candidate_transforms[key_index_set] = (
+                self._search_candidate_transforms(key_index_set))
+        return self._candidate_transforms[key_index_set]
 
+    def _search_candidate_transforms(self, key_index_set):
         # Assume that all the registered transformations are
         # disjoint on the outputs
-        key_indices = list(key_indices)  # sometimes we get ranges
         transforms = []
         operands = set()
         # Look for the transforms that produce the
@@ -55,13 +66,77 @@ class _TransformBase(tabular_dataset.TabularDataset):
             # contained holds the transf. indexes that belong to key_indices
             # An element that is not required by key_indices,
             # its index is replaced with None.
-            contained = [r if r in key_indices else None for r in res_idx]
-            if any(r is not None for r in contained):
-                # Now look the indices of the keys we need to fetch
-                # from the original dataset to apply this transformation
-                operands.update(ops_idx)
-                transforms.append((ops_idx, t, contained))
-        return list(operands), transforms
+            if key_index_set.isdisjoint(res_idx):
+                continue
+            contained = tuple(
+                r if r in key_index_set else None for r in res_idx)
+            # Now look the indices of the keys we need to fetch
+            # from the original dataset to apply this transformation
+            operands.update(ops_idx)
+            transforms.append((ops_idx, t, contained))
+        return tuple(operands), tuple(transforms)
+
+    def _update_mode(self, out_example):
+        if isinstance(out_example, tuple):
+            mode = tuple
+        elif isinstance(out_example, dict):
+            mode = dict
+        else:
+            mode = None
+        if hasattr(self, "_mode") and self._mode is not mode:
+            raise ValueError(
+                "{} must not change its return type".format(self._name))
+        self._mode = mode
+
+    def _check_length(self, out_example, len_):
+        if isinstance(out_example, tuple):
+            columns = out_example
+        elif isinstance(out_example, dict):
+            columns = out_example.values()
+        else:
+            columns = (out_example,)
+        if not all(len(col) == len_ for col in columns):
+            raise ValueError(
+                "{} must not change the length of data".format(self._name))
+
+    def _plan_transforms(self, key_indices):
+        key_indices = tuple(key_indices)
+        if key_indices not in self._plans:
+            self._plans[key_indices] = self._build_plan(key_indices)
+        return self._plans[key_indices]
+
+    def _build_plan(self, key_indices):
+        ops_idx, transforms = self._find_candidate_transforms(key_indices)
+        # The size of in_example might not be the same
+        # for the transformations.
+        # Suppose we have 5 dimensions, a, b, c, d, e
+        # Trans 1 uses a, d and Trans 2 uses only c
+        # the selection returns a 3 element array of (a,c,d)
+        # where trans 1 needs elems 0 and 2 and trans 2 needs 1
+        # So we need to select the inputs accordingly.
+        # The positions of the inputs and of the outputs are resolved
+        # here once so that the per-example loop does no lookups.
+        op_positions = _positions(ops_idx)
+        out_positions = _positions(key_indices)
+        plan = []
+        for t_op_idx, transform, t_res_idx in transforms:
+            input_positions = tuple(op_positions[i] for i in t_op_idx)
+            if self._dataset.mode is dict:
+                names = tuple(self._dataset.keys[i] for i in t_op_idx)
+            else:
+                names = None
+            # t_res_idx should directly map the output, when
+            # all the outputs are covered this works but when
+            # we are slicing the outputs using key_indices
+            # the result key index needs to be recalculated
+            outputs = tuple(
+                (col_index, self._keys[key_index], out_positions[key_index])
+                for col_index, key_index in enumerate(t_res_idx)
+                if key_index is not None)
+            plan.append((
+                input_positions, _make_getter(input_positions), names,
+                transform, outputs))
+        return ops_idx, tuple(plan)
 
     def convert(self, data):
         return self._dataset.convert(data)
@@ -69,83 +144,189 @@ class _TransformBase(tabular_dataset.TabularDataset):
 
 class _Transform(_TransformBase):
 
+    _name = 'transform'
+
+    def __init__(self, dataset, keys, transforms):
+        super().__init__(dataset, keys, transforms)
+        self._loops = {}
+
+    def __getstate__(self):
+        # Generated loops cannot be pickled, they are rebuilt on demand
+        state = self.__dict__.copy()
+        state['_loops'] = {}
+        return state
+
+    def _build_plan(self, key_indices):
+        # Batchable transformations are told apart here once instead of
+        # looking up the attribute of every transformation on each call
+        ops_idx, plan = super()._build_plan(key_indices)
+        batch_plan = tuple(
+            entry for entry in plan if getattr(entry[3], 'batchable', False))
+        row_plan = tuple(
+            entry for entry in plan
+            if not getattr(entry[3], 'batchable', False))
+        row_out_indices = tuple(
+            out_index
+            for _, _, _, _, outputs in row_plan
+            for _, _, out_index in outputs)
+        return ops_idx, batch_plan, row_plan, row_out_indices
+
     def get_examples(self, indices, key_indices):
         if key_indices is None:
             key_indices = range(len(self._keys))
-        ops_idx, transforms = self._find_candidate_transforms(key_indices)
+        key_indices = tuple(key_indices)
+        ops_idx, batch_plan, row_plan, row_out_indices = (
+            self._plan_transforms(key_indices))
         in_examples = self._dataset.get_examples(indices, ops_idx)
-        out_examples = tuple([] for _ in key_indices)
-
-        for in_example in zip(*in_examples):
-            for t_op_idx, transform, t_res_idx in transforms:
-                # The size of in_example might not be the same
-                # for the transformations.
-                # Suppose we have 5 dimensions, a, b, c, d, e
-                # Trans 1 uses a, d and Trans 2 uses only c
-                # the selection returns a 3 element array of (a,c,d)
-                # where trans 1 needs elems 0 and 2 and trans 2 needs 1
-                # So we need to select the inputs accordingly
-                # Recalculate the ops indexes to reflect this
-                inputs = [in_example[ops_idx.index(i)] for i in t_op_idx]
-                if self._dataset.mode is tuple:
-                    # Should be always be a tuple with the correct value
-                    out_example = transform(*inputs)
-                elif self._dataset.mode is dict:
-                    keys = [self._dataset.keys[i] for i in ops_idx]
-                    out_example = transform(
-                        **dict(zip(keys, inputs))
-                    )
-                elif self._dataset.mode is None:
-                    out_example = transform(*inputs)
-                if isinstance(out_example, tuple):
-                    if hasattr(self, "_mode") and self._mode is not tuple:
-                        raise ValueError(
-                            "transform must not change its return type"
-                        )
-                    self._mode = tuple
-                    for col_index, key_index in enumerate(t_res_idx):
-                        if key_index is None:
-                            continue
-                        # t_res_idx should directly map the output, when
-                        # all the outputs are covered this works but when
-                        # we are slicing the outputs using key_indices
-                        # the result key index needs to be recalculated
-                        out_examples[key_indices.index(key_index)].append(
-                            out_example[col_index])
-                elif isinstance(out_example, dict):
-                    if hasattr(self, "_mode") and self._mode is not dict:
-                        raise ValueError(
-                            "transform must not change its return type"
-                        )
-                    self._mode = dict
-                    for _, key_index in enumerate(t_res_idx):
-                        if key_index is None:
-                            continue
-                        key = self._keys[key_index]
-                        out_examples[key_indices.index(key_index)].append(
-                            out_example[key]
-                        )
-                else:
-                    if hasattr(self, "_mode") and self._mode is not None:
-                        raise ValueError(
-                            "transform must not change its return type"
-                        )
-                    self._mode = None
-                    out_example = (out_example,)
-                    for col_index, key_index in enumerate(t_res_idx):
-                        if key_index is None:
-                            continue
-                        out_examples[key_indices.index(key_index)].append(
-                            out_example[col_index])
+        len_ = len(in_examples[0]) if len(in_examples) > 0 else 0
+        # The number of examples is known, so the columns are allocated
+        # upfront and filled by index instead of growing them
+        out_examples = tuple([None] * len_ for _ in key_indices)
+
+        # Batchable transformations take the whole columns at once
+        for _, get_inputs, names, transform, outputs in batch_plan:
+            out_example = _apply(transform, names, get_inputs(in_examples))
+            self._update_mode(out_example)
+            self._check_length(out_example, len_)
+            for col_index, key, out_index in outputs:
+                # The length was checked above, so the slice assignment
+                # keeps the preallocated length of the column
+                out_examples[out_index][:] = _select(
+                    out_example, col_index, key)
+
+        if len(row_plan) == 0:
+            return out_examples
+
+        rows = zip(*in_examples)
+        start = 0
+        if not hasattr(self, "_mode"):
+            # The first transformed example determines the mode
+            start = self._get_examples_any(
+                itertools.islice(rows, 1), row_plan, out_examples)
+        if hasattr(self, "_mode"):
+            loop_key = (key_indices, self._mode)
+            if loop_key not in self._loops:
+                self._loops[loop_key] = _compile_loop(
+                    row_plan, self._mode, self._name)
+            columns = tuple(
+                out_examples[out_index] for out_index in row_out_indices)
+            self._loops[loop_key](rows, columns, start)
 
         return out_examples
 
+    def _get_examples_any(self, rows, row_plan, out_examples):
+        n_rows = 0
+        for row_index, in_example in enumerate(rows):
+            for _, get_inputs, names, transform, outputs in row_plan:
+                out_example = _apply(
+                    transform, names, get_inputs(in_example))
+                self._update_mode(out_example)
+                for col_index, key, out_index in outputs:
+                    out_examples[out_index][row_index] = _select(
+                        out_example, col_index, key)
+            n_rows += 1
+        return n_rows
+
     def convert(self, data):
         return self._dataset.convert(data)
 
 
+def _compile_loop(row_plan, mode, name):
+    # Generates the loop over the examples with the calls to every
+    # transformation and the stores of their outputs inlined, e.g.
+    #
+    #     def _loop(rows, columns, start):
+    #         column0, column1, column2 = columns
+    #         for i, row in enumerate(rows, start):
+    #             out0 = transform0(row[0], row[2])
+    #             column0[i] = out0[0]
+    #             column2[i] = out0[1]
+    #             out1 = transform1(row[1])
+    #             column1[i] = out1[0]
+    #
+    # so that no tuple packing or plan lookups happen between the calls
+    namespace = {'message': '{} must not change its return type'.format(name)}
+    lines = []
+    n_columns = 0
+    for i, (input_positions, _, names, transform, outputs) in enumerate(
+            row_plan):
+        namespace['transform{}'.format(i)] = transform
+        inputs = ['row[{}]'.format(p) for p in input_positions]
+        if names is None:
+            args = ', '.join(inputs)
+        else:
+            for j, op_name in enumerate(names):
+                namespace['name{}_{}'.format(i, j)] = op_name
+            args = '**{{{}}}'.format(', '.join(
+                'name{}_{}: {}'.format(i, j, x) for j, x in enumerate(inputs)))
+        lines.append('out{} = transform{}({})'.format(i, i, args))
+        if mode is tuple:
+            check = 'not isinstance(out{}, tuple)'.format(i)
+        elif mode is dict:
+            check = 'not isinstance(out{}, dict)'.format(i)
+        else:
+            check = 'isinstance(out{}, (tuple, dict))'.format(i)
+        lines.append('if {}:'.format(check))
+        lines.append('    raise ValueError(message)')
+        for col_index, key, _ in outputs:
+            if mode is tuple:
+                value = 'out{}[{}]'.format(i, col_index)
+            elif mode is dict:
+                namespace['key{}'.format(n_columns)] = key
+                value = 'out{}[key{}]'.format(i, n_columns)
+            else:
+                value = 'out{}'.format(i)
+            lines.append('column{}[i] = {}'.format(n_columns, value))
+            n_columns += 1
+
+    source = 'def _loop(rows, columns, start):\n'
+    source += '    {}, = columns\n'.format(
+        ', '.join('column{}'.format(i) for i in range(n_columns)))
+    source += '    for i, row in enumerate(rows, start):\n'
+    source += ''.join('        {}\n'.format(line) for line in lines)
+    exec(source, namespace)
+    return namespace['_loop']
+
+
+def _positions(indices):
+    # Maps each index to its position, the first occurrence wins as in
+    # list.index but every lookup is O(1)
+    positions = {}
+    for position, index in enumerate(indices):
+        positions.setdefault(index, position)
+    return positions
+
+
+def _make_getter(positions):
+    # itemgetter returns a bare element instead of a tuple when it is
+    # given a single position, a slice keeps the result a sequence.
+    # Unlike a lambda, itemgetter can be pickled along with the plan.
+    if len(positions) == 1:
+        position, = positions
+        return operator.itemgetter(slice(position, position + 1))
+    if len(positions) == 0:
+        return operator.itemgetter(slice(0, 0))
+    return operator.itemgetter(*positions)
+
+
+def _apply(transform, names, inputs):
+    if names is None:
+        return transform(*inputs)
+    return transform(**dict(zip(names, inputs)))
+
+
+def _select(out_example, col_index, key):
+    if isinstance(out_example, tuple):
+        return out_example[col_index]
+    elif isinstance(out_example, dict):
+        return out_example[key]
+    return out_example
+
+
 class _TransformBatch(_TransformBase):
 
+    _name = 'transform_batch'
+
     def get_examples(self, indices, key_indices):
         if indices is None:
             len_ = len(self)
@@ -158,70 +339,13 @@ class _TransformBatch(_TransformBase):
         if key_indices is None:
             key_indices = range(len(self._keys))
 
-        ops_idx, transforms = self._find_candidate_transforms(key_indices)
+        ops_idx, plan = self._plan_transforms(key_indices)
         in_examples = self._dataset.get_examples(indices, ops_idx)
-        out_examples = [None for _ in key_indices]
-        for t_op_idx, transform, t_res_idx in transforms:
-            inputs = [in_examples[ops_idx.index(i)] for i in t_op_idx]
-            if self._dataset.mode is tuple:
-                out_example = transform(*inputs)
-            elif self._dataset.mode is dict:
-                keys = [self._dataset.keys[i] for i in ops_idx]
-                out_example = transform(
-                    **dict(zip(keys, inputs))
-                )
-            elif self._dataset.mode is None:
-                out_example = transform(*inputs)
-
-            if isinstance(out_example, tuple):
-                if hasattr(self, "_mode") and self._mode is not tuple:
-                    raise ValueError(
-                        "transform_batch must not change its return type"
-                    )
-                self._mode = tuple
-                if not all(len(col) == len_ for col in out_example):
-                    raise ValueError(
-                        "transform_batch must not change the length of data"
-                    )
-                for col_index, key_index in enumerate(t_res_idx):
-                    if key_index is None:
-                        continue
-                    # t_res_idx should directly map the output, when
-                    # all the outputs are covered this works but when
-                    # we are slicing the outputs using key_indices
-                    # the result key index needs to be recalculated
-                    out_examples[key_indices.index(key_index)] = (
-                        out_example[col_index])
-            elif isinstance(out_example, dict):
-                if hasattr(self, "_mode") and self._mode is not dict:
-                    raise ValueError(
-                        "transform must not change its return type"
-                    )
-                self._mode = dict
-                if not all(len(col) == len_ for col in out_example.values()):
-                    raise ValueError(
-                        "transform_batch must not change the length of data"
-                    )
-                for _, key_index in enumerate(t_res_idx):
-                    if key_index is None:
-                        continue
-                    key = self._keys[key_index]
-                    out_examples[key_indices.index(key_index)] = (
-                        out_example[key])
-            else:
-                if hasattr(self, "_mode") and self._mode is not None:
-                    raise ValueError(
-                        "transform must not change its return type"
-                    )
-                self._mode = None
-                out_example = (out_example,)
-                if not all(len(col) == len_ for col in out_example):
-                    raise ValueError(
-                        "transform_batch must not change the length of data"
-                    )
-                for col_index, key_index in enumerate(t_res_idx):
-                    if key_index is None:
-                        continue
-                    out_examples[key_indices.index(key_index)] = (
-                        out_example[col_index])
+        out_examples = [None] * len(key_indices)
+        for _, get_inputs, names, transform, outputs in plan:
+            out_example = _apply(transform, names, get_inputs(in_examples))
+            self._update_mode(out_example)
+            self._check_length(out_example, len_)
+            for col_index, key, out_index in outputs:
+                out_examples[out_index] = _select(out_example, col_index, key)
         return tuple(out_examples)
@@ -229,6 +229,10 @@ class TabularDataset(Dataset):
         When multiple transformations are specified, the outputs
         must be disjoint or `ValueError` will be risen.
 
+        A callable that has a ``batchable`` attribute set to ``True``
+        is invoked only once with whole columns instead of once per
+        example, in the same way as :meth:`transform_batch`.
+
         Args:
             keys (tuple of strs): The keys of transformed examples.
             transform (list of tuples): A list where each element
@@ -1,4 +1,4 @@
-from typing import Any, Callable, Dict, Optional, TYPE_CHECKING
+from typing import Any, Callable, Dict, NoReturn, Optional, TYPE_CHECKING
 import types
 
 if TYPE_CHECKING:
@@ -72,13 +72,20 @@ class Extension:
         raise NotImplementedError(
             'Extension implementation must override __call__.')
 
-    def __getattr__(self, name: str) -> Any:
-        if name == 'invoke_before_training':
-            raise AttributeError(
+    @property
+    def invoke_before_training(self) -> NoReturn:
+        raise AttributeError(
+            'invoke_before_training has been removed since Chainer '
+            'v2.0.0. Use Extension.initialize instead.')
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        # Checked once at class creation rather than through __getattr__,
+        # which would slow down every missed attribute lookup.
+        super().__init_subclass__(**kwargs)
+        if 'invoke_before_training' in vars(cls):
+            raise TypeError(
                 'invoke_before_training has been removed since Chainer '
                 'v2.0.0. Use Extension.initialize instead.')
-        raise AttributeError('{} object has no attribute {}'.format(
-            type(self).__name__, name))
 
     def finalize(self) -> None:
         """Finalizes the extension.
@@ -146,6 +153,11 @@ class _WrappedExtension(Extension):
         self._ext = ext
         self.trigger = getattr(self._ext, 'trigger', Extension.trigger)
         self.priority = getattr(self._ext, 'priority', Extension.priority)
+        # Resolve the optional hooks once instead of on every invocation
+        self._finalize = getattr(self._ext, 'finalize', super().finalize)
+        self._initialize = getattr(
+            self._ext, 'initialize', super().initialize)
+        self._on_error = getattr(self._ext, 'on_error', super().on_error)
         super().__init__()
 
     @property
@@ -156,10 +168,10 @@ class _WrappedExtension(Extension):
         self._ext(manager)
 
     def finalize(self) -> None:
-        getattr(self._ext, 'finalize', super().finalize)()
+        self._finalize()
 
     def initialize(self, manager: '_BaseExtensionsManager') -> None:
-        getattr(self._ext, 'initialize', super().initialize)(manager)
+        self._initialize(manager)
 
     def on_error(
             self,
@@ -167,7 +179,7 @@ class _WrappedExtension(Extension):
             exc: Exception,
             tb: types.TracebackType,
     ) -> None:
-        getattr(self._ext, 'on_error', super().on_error)(manager, exc, tb)
+        self._on_error(manager, exc, tb)
 
 
 _OnErrorType = Callable[
@@ -1,23 +1,26 @@
 from pytorch_pfn_extras.training import extension
-from pytorch_pfn_extras.training import trigger as trigger_module
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 
+_MISSING = object()
+
+
 def _get_value_from_log_report(manager, key):
     # Find and return the latest reported "key" from LogReport
     if key is None:
         return None
-    if key not in manager.observation:
+    value = manager.observation.get(key, _MISSING)
+    if value is _MISSING:
         raise ValueError(
             '{} is not found in the reported values {}'.format(
                 key, manager.observation))
 
-    return manager.observation[key]
+    return value
 
 
 def _default_stepper(manager, scheduler):
     if isinstance(scheduler, ReduceLROnPlateau):
-        LRScheduler.step_by_value('val/loss')(manager, scheduler)
+        _step_by_val_loss(manager, scheduler)
     else:
         scheduler.step()
 
@@ -44,7 +47,9 @@ class LRScheduler(extension.Extension):
             stepper=_default_stepper,
             trigger=(1, 'epoch')):
         self.scheduler = scheduler
-        self.trigger = trigger_module.get_trigger(trigger)
+        # The manager builds the trigger object when the extension is
+        # registered, like for the class-level defaults of other extensions
+        self.trigger = trigger
         self.stepper = stepper
 
     def __call__(self, manager):
@@ -61,3 +66,6 @@ class LRScheduler(extension.Extension):
 
     def load_state_dict(self, state):
         self.scheduler.load_state_dict(state['scheduler'])
+
+
+_step_by_val_loss = LRScheduler.step_by_value('val/loss')
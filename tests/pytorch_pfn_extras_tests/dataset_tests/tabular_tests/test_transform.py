@@ -1,4 +1,5 @@
 import itertools
+import pickle
 
 import numpy as np
 import pytest
@@ -221,6 +222,36 @@ class TestTransformInvalid:
         with pytest.raises(ValueError):
             view.get_examples([0], None)
 
+    def test_transform_inconsistent_mode_after_first(self, mode):
+        dataset = dummy_dataset.DummyDataset()
+        count = {'n': 0}
+
+        # The first example goes through the mode detection and the
+        # rest through the generated loop, where the mode changes
+        def transform(a, b, c):
+            count['n'] += 1
+            if count['n'] == 1:
+                out_mode = mode
+            elif mode is tuple:
+                out_mode = dict
+            elif mode is dict:
+                out_mode = None
+            elif mode is None:
+                out_mode = tuple
+
+            if out_mode is tuple:
+                return a,
+            elif out_mode is dict:
+                return {'a': a}
+            elif out_mode is None:
+                return a
+
+        view = dataset.transform(
+            ('a',),
+            [((('a', 'b', 'c'), ('a',)), transform)])
+        with pytest.raises(ValueError):
+            view.get_examples(None, None)
+
     def test_transform_batch_inconsistent_mode(self, mode):
         dataset = dummy_dataset.DummyDataset()
         self.mode = mode
@@ -248,3 +279,127 @@ class TestTransformInvalid:
             [((('a', 'b', 'c'), ('a',)), transform_batch)])
         with pytest.raises(ValueError):
             view.get_examples(None, None)
+
+    def test_transform_batchable_length_changed(self, mode):
+        dataset = dummy_dataset.DummyDataset()
+        self.mode = mode
+
+        def transform(a, b, c):
+            if self.mode is tuple:
+                return a + [0],
+            elif self.mode is dict:
+                return {'a': a + [0]}
+            elif self.mode is None:
+                return a + [0]
+        transform.batchable = True
+
+        view = dataset.transform(
+            ('a',),
+            [((('a', 'b', 'c'), ('a',)), transform)])
+        with pytest.raises(ValueError):
+            view.get_examples(None, None)
+
+
+def _get_inputs(in_mode, keys, args, kwargs):
+    if in_mode is dict:
+        assert len(args) == 0
+        assert tuple(kwargs) == keys
+        return tuple(kwargs[key] for key in keys)
+    assert len(args) == len(keys)
+    assert len(kwargs) == 0
+    return args
+
+
+@pytest.mark.parametrize('in_mode', [tuple, dict, None])
+@pytest.mark.parametrize('out_mode', [tuple, dict, None])
+@pytest.mark.parametrize('indices', [None, [1, 3], slice(None, 2)])
+def test_transform_batchable(in_mode, out_mode, indices):
+    dataset = dummy_dataset.DummyDataset(mode=in_mode, return_array=True)
+    if in_mode is not None:
+        alpha_keys, beta_keys = ('a', 'b'), ('c',)
+    else:
+        alpha_keys, beta_keys = ('a',), ('a',)
+    count = {'alpha': 0, 'beta': 0}
+
+    def transform_alpha(*args, **kwargs):
+        count['alpha'] += 1
+        inputs = _get_inputs(in_mode, alpha_keys, args, kwargs)
+        assert all(isinstance(x, np.ndarray) for x in inputs)
+        if out_mode is tuple:
+            return sum(inputs),
+        elif out_mode is dict:
+            return {'alpha': sum(inputs)}
+        elif out_mode is None:
+            return sum(inputs)
+    transform_alpha.batchable = True
+
+    def transform_beta(*args, **kwargs):
+        count['beta'] += 1
+        x, = _get_inputs(in_mode, beta_keys, args, kwargs)
+        assert isinstance(x, float)
+        if out_mode is tuple:
+            return x * 2,
+        elif out_mode is dict:
+            return {'beta': x * 2}
+        elif out_mode is None:
+            return x * 2
+
+    view = dataset.transform(
+        ('alpha', 'beta'),
+        [((alpha_keys, ('alpha',)), transform_alpha),
+         ((beta_keys, ('beta',)), transform_beta)])
+    output = view.get_examples(indices, None)
+
+    columns = dict(zip(dataset.keys, dataset.data))
+    data = np.vstack((
+        sum(columns[key] for key in alpha_keys),
+        columns[beta_keys[0]] * 2))
+    if indices is not None:
+        data = data[:, indices]
+    for out, d in itertools.zip_longest(output, data):
+        np.testing.assert_equal(out, d)
+        assert isinstance(out, list)
+    assert view.mode == out_mode
+    assert count['alpha'] == 1
+    assert count['beta'] == len(data[0])
+
+
+@pytest.mark.parametrize('with_batch', [False, True])
+def test_transform_dict_disjoint_inputs(with_batch):
+    dataset = dummy_dataset.DummyDataset(mode=dict, return_array=True)
+
+    def transform_alpha(a):
+        return a * 2,
+
+    def transform_beta(c):
+        return c * 3,
+
+    d_transform = [
+        ((('a',), ('alpha',)), transform_alpha),
+        ((('c',), ('beta',)), transform_beta)]
+    if with_batch:
+        view = dataset.transform_batch(('alpha', 'beta'), d_transform)
+    else:
+        view = dataset.transform(('alpha', 'beta'), d_transform)
+    output = view.get_examples(None, None)
+
+    a, _, c = dataset.data
+    for out, d in itertools.zip_longest(output, (a * 2, c * 3)):
+        np.testing.assert_equal(out, d)
+
+
+def _transform_pickle(a, b, c):
+    return a + b, b + c
+
+
+def test_transform_pickle():
+    dataset = dummy_dataset.DummyDataset()
+    view = dataset.transform(
+        ('alpha', 'beta'),
+        [((('a', 'b', 'c'), ('alpha', 'beta')), _transform_pickle)])
+    expected = view.get_examples([1, 3], None)
+
+    view = pickle.loads(pickle.dumps(view))
+    output = view.get_examples([1, 3], None)
+    for out, d in itertools.zip_longest(output, expected):
+        np.testing.assert_equal(out, d)
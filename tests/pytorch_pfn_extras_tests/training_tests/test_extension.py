@@ -39,10 +39,17 @@ def test_deleted_invoke_before_training():
         pass
 
     ext = MyExtension()
-    with pytest.raises(AttributeError):
+    with pytest.raises(AttributeError, match='Extension.initialize'):
         ext.invoke_before_training
 
 
+def test_define_invoke_before_training():
+    with pytest.raises(TypeError):
+        class MyExtension(ppe.training.Extension):
+            def invoke_before_training(self):
+                pass
+
+
 def test_make_extension():
     initialize = mock.Mock()
 